@@ -2,7 +2,7 @@ import numpy as np
 import numpy.random as random
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial import cKDTree
 
 # 2d variant for simplicity
 
@@ -41,38 +41,55 @@ class gas_simulation_2d:
         # updating positions of the particles
         self.pos = self.pos + self.vel * dt
 
-        # finding colliding particles, can be improved by creating a grid
-        distances = squareform(pdist(self.pos))
-        ind1, ind2 = np.where(distances < 2 * self.radius)
-        unique = (ind1 < ind2)
-        ind1 = ind1[unique]
-        ind2 = ind2[unique]
+        # finding colliding particles with a kd-tree, pairs are sorted to be processed in the same order every time
+        pairs = cKDTree(self.pos).query_pairs(2 * self.radius, output_type='ndarray')
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        ind1, ind2 = pairs[:, 0], pairs[:, 1]
 
-        # calculating the result of the collision
-        for i1, i2 in zip(ind1, ind2):
+        # calculating the result of the collision in batches. A batch takes every pair which is the first remaining
+        # pair of both of its particles, so no particle is in a batch twice and every particle still goes through its
+        # collisions in the same order as the pairs are sorted
+        order = np.arange(len(ind1))
+        while len(ind1):
+            first = np.full(self.partcount, order[-1] + 1)
+            np.minimum.at(first, ind1, order)
+            np.minimum.at(first, ind2, order)
+            batch = (first[ind1] == order) & (first[ind2] == order)
+            i1, i2 = ind1[batch], ind2[batch]
             vel_cm = (self.vel[i1] + self.vel[i2]) / 2
             vec_normal = self.pos[i1] - self.pos[i2]
             vel_normal = self.vel[i1] - self.vel[i2]
-            vel_change = 2 * np.dot(vec_normal, vel_normal) * vec_normal / np.dot(vec_normal, vec_normal) - vel_normal
+            dist_sq = np.einsum('ij,ij->i', vec_normal, vec_normal)
+            k = 2 * np.einsum('ij,ij->i', vec_normal, vel_normal) / dist_sq
+            vel_change = k[:, None] * vec_normal - vel_normal
             self.vel[i1] = vel_cm - vel_change / 2
             self.vel[i2] = vel_cm + vel_change / 2
-            self.pos[i1] += self.vel[i1] * dt
-            self.pos[i2] += self.vel[i2] * dt
 
-        # finding particles colliding with the wall
+            # positions were already updated, so particles are only pushed apart by a half of the overlap each, pairs
+            # which were already moved apart by the previous batches are not pulled back
+            dist = np.sqrt(dist_sq)
+            push = (np.maximum(2 * self.radius - dist, 0) / (2 * dist))[:, None] * vec_normal
+            self.pos[i1] += push
+            self.pos[i2] -= push
+            ind1, ind2, order = ind1[~batch], ind2[~batch], order[~batch]
+
+        # finding particles colliding with the wall, values which are the same for every particle are computed once
+        pos, vel = self.pos, self.vel
+        low, high = self.radius, self.side_length - self.radius
+        place_low, place_high = self.radius * 1.01, self.side_length - (self.radius * 1.01)
         for i in range(self.partcount):
-            if self.pos[i, [0]] - self.radius < 0:
-                self.vel[i, [0]] = -self.vel[i, [0]]
-                self.pos[i, [0]] = self.radius * 1.01
-            if self.pos[i, [0]] + self.radius > self.side_length:
-                self.vel[i, [0]] = -self.vel[i, [0]]
-                self.pos[i, [0]] = self.side_length - (self.radius * 1.01)
-            if self.pos[i, [1]] - self.radius < 0:
-                self.vel[i, [1]] = -self.vel[i, [1]]
-                self.pos[i, [1]] = self.radius * 1.01
-            if self.pos[i, [1]] + self.radius > self.side_length:
-                self.vel[i, [1]] = -self.vel[i, [1]]
-                self.pos[i, [1]] = self.side_length - (self.radius * 1.01)
+            if pos[i, 0] < low:
+                vel[i, 0] = -vel[i, 0]
+                pos[i, 0] = place_low
+            if pos[i, 0] > high:
+                vel[i, 0] = -vel[i, 0]
+                pos[i, 0] = place_high
+            if pos[i, 1] < low:
+                vel[i, 1] = -vel[i, 1]
+                pos[i, 1] = place_low
+            if pos[i, 1] > high:
+                vel[i, 1] = -vel[i, 1]
+                pos[i, 1] = place_high
 
 def init():
     global abobus_2d
@@ -2,41 +2,77 @@ import numpy as np
 import numpy.random as random
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
-from scipy.spatial.distance import pdist, squareform
+from numba import njit, prange, cuda
+
+# offsets of the cell itself and of a half of its neighbouring cells, see '_step_kernel'
+NEIGHBOUR_OFFSETS = np.array([(dx, dy, dz) for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                              if (dz, dy, dx) >= (0, 0, 0)])
+THREADS_PER_BLOCK = 128  # size of a block of threads for CUDA kernels
 
 """
 All particles are considered to have the same constant parameters i.e. mass, radius.
-Initial speeds are determined by temperature, from which the speeds are calculated by thermal velocity equation.
+Initial speeds are determined by temperature, from which the speeds are drawn from Maxwell-Boltzmann distribution.
 
 """
 
 class GasSimulation3d:
 
-    def __init__(self, particlesCount=2000, mass=5e-20, effectiveRadius=2e-10, volume=1e-23, T=300):
+    def __init__(self, particlesCount=2000, mass=5e-20, effectiveRadius=2e-10, volume=1e-23, T=300, backend='cpu',
+                 cellCapacity=16, graphs=True, skin=0.0):
         """
-        Initializing starting parameters
+        Initializing starting parameters. Backend is either 'cpu' or 'cuda', in the latter case the simulation runs on
+        the GPU and cellCapacity is the maximum amount of particles in a single cell of the grid. Matplotlib graphs are
+        only created if graphs is True, otherwise the simulation can be drawn by 'QtView'. Skin is an extra width of the
+        cells of the grid, which lets the grid be reused for several steps, see 'Step'.
         """
+        if backend not in ('cpu', 'cuda'):
+            raise ValueError("backend must be either 'cpu' or 'cuda', got {!r}".format(backend))
+        self.backend = backend  # where the simulation is computed
         self.partCount = particlesCount  # the amount of particles in simulation
         self.mass = mass  # the mass of any particle
         self.radius = effectiveRadius  # radius of the molecule i.e. distance at which particles will start colliding
         self.volume = volume  # volume of the observed chamber
         self.temp = T  # average temperature of the gas
-        self.pos = np.zeros((self.partCount, 3))  # array which will contain particles coordinates
-        self.vel = np.zeros((self.partCount, 3))  # array which will contain particles velocities
-        self.particleCell = {}
-        self.cubicParts1 = int(np.floor(self.partCount ** (1 / 3)))  # created for optimizing future calculations
+        self.px = np.zeros(self.partCount)  # arrays which will contain particles coordinates along x, y, z axes
+        self.py = np.zeros(self.partCount)
+        self.pz = np.zeros(self.partCount)
+        self.vx = np.zeros(self.partCount)  # arrays which will contain particles velocities along x, y, z axes
+        self.vy = np.zeros(self.partCount)
+        self.vz = np.zeros(self.partCount)
+        self.vel_hist_data = np.zeros(self.partCount)  # array which will contain absolute speeds of the particles
+        self.vel_hist_scratch = np.empty(self.partCount)  # scratch buffer for computing the speeds in place
+        self.histRange = (0, 1.5)  # range and amount of bins of the speed histogram
+        self.histBins = 100
+        self.cubicParts1 = int(round(self.partCount ** (1 / 3)))  # created for optimizing future calculations
+        if self.cubicParts1 ** 3 > self.partCount:  # rounding down to the nearest cube, which float root can miss
+            self.cubicParts1 -= 1
         self.cubicParts2 = (self.cubicParts1 ** 2)  # created for optimizing future calculations
-        self.cellLength = self.sideLength / self.cubicParts1 # the length of a side of a single cell
 
         """
         Calculating needed parameters from initial conditions.
         """
         self.b = self.partCount * ((4 / 3) * np.pi * (self.radius ** 3))  # idk what this is i forgot
         self.sideLength = (volume ** (1 / 3))  # length of the side of observed chamber
+        self.cellsPerSide = max(1, int(self.sideLength // (2 * self.radius + skin)))  # amount of grid cells along a side
+        self.cellLength = self.sideLength / self.cellsPerSide  # the length of a side of a single cell, at least 2 radii
+        self.maxDrift = (self.cellLength - 2 * self.radius) / 2  # how far particles can go before the grid is rebuilt
+        self.cellCount = self.cellsPerSide ** 3  # total amount of grid cells
+        self.sortedIdx = np.empty(self.partCount, dtype=np.int64)  # compressed list of the particles in each cell
+        self.cellStart = np.empty(self.cellCount + 1, dtype=np.int64)  # after the last step, see '_step_kernel'
+        self.cellKeys = np.empty(self.partCount, dtype=np.int64)  # scratch buffers which are reused by every step
+        self.cellFill = np.empty(self.cellCount, dtype=np.int64)
+        self.cellColours = np.empty(self.partCount, dtype=np.int64)
+        self.colourCells = np.empty(self.partCount, dtype=np.int64)  # occupied cells grouped by colour, see '_step_kernel'
+        self.colourStart = np.empty(28, dtype=np.int64)
+        self.gridPos = [np.zeros(self.partCount) for _ in range(3)]  # positions at which the grid was built
+        self.gridBuilds = 0  # how many times the grid was built, the first step always builds it
         self.velNormalized = (3 * 1.87e-23 * self.temp / self.mass) ** (1 / 2)  # root mean square of speed of molecules
-        self.cellBelonging = dict()  # this array is explained in 'Step'
+        self.cellCapacity = cellCapacity  # maximum amount of particles in a cell on the GPU
         self.SetParticles()  # initializing particle initializing method
-        self.SetGraphs()  # initializing graph initializing method
+        if self.backend == 'cuda':
+            self.SetDevice()  # copying the particles to the GPU
+        if graphs:
+            self.SetGraphs()  # initializing graph initializing method
 
 
     def SetParticles(self):
@@ -49,16 +85,14 @@ class GasSimulation3d:
         """
         Calculating positions of the edges of the grid inside the chamber with extra space near walls taken into account
         """
-        dists = np.linspace(self.radius * 5, self.sideLength - self.radius * 5, int(np.floor(self.partCount ** (1 / 3))))
+        dists = np.linspace(self.radius * 5, self.sideLength - self.radius * 5, self.cubicParts1)
 
         """
         Assigning particles to cells.
         If the amount of particles n is not a perfect cube, we round it down to a nearest cube m ** 3, create a grid
         inside of a chamber with side length of m. Then we assign particles into this grid one by one. Coordinates
-        matrix has a format of [[x_1, y_1, z_1]
-                                [x_2, y_2, z_2]
-                                    ......
-                                [x_n, y_n, z_n]]
+        are kept in three separate arrays, one per axis: px = [x_1, x_2, ..., x_n], py = [y_1, ..., y_n],
+        pz = [z_1, ..., z_n].
         
         EXAMPLE:
         Consider we have 40 particles. We then round it down to nearest cube, which is 27. Thus we create a meshgrid
@@ -69,25 +103,22 @@ class GasSimulation3d:
         """
 
         #assigning coordinates
-        self.pos = np.zeros((self.partCount, 3))
-        for i in range(self.partCount):
-            temp = i % (self.cubicParts1 ** 3)
-            self.pos[i, :] = np.array([dists[int(temp % self.cubicParts1)] + random.rand(1)[0] * (self.radius * 0.5),
-                                       dists[int((temp % self.cubicParts2) // self.cubicParts1)] + random.rand(1)[0] * (self.radius * 0.5),
-                                       dists[int(temp // self.cubicParts2)] + random.rand(1)[0] * (self.radius * 0.5)])
-
-        #filling the dictionary with all the keys for all the cells
-        for i in range(self.cubicParts1):
-            self.cellBelonging[i] = list()
+        temp = np.arange(self.partCount) % (self.cubicParts1 ** 3)
+        shift = random.rand(self.partCount, 3) * (self.radius * 0.5)
+        self.px = dists[temp % self.cubicParts1] + shift[:, 0]
+        self.py = dists[(temp % self.cubicParts2) // self.cubicParts1] + shift[:, 1]
+        self.pz = dists[temp // self.cubicParts2] + shift[:, 2]
 
         """
-        Creating random speed matrix where values are placed in as:
-        [[V_x_1, V_y_1, V_z_1] - speeds of the first particle projected on x, y, z axes  
-         [V_x_2, V_y_2, V_z_2] - speeds of the second particle projected on x, y, z axes
-                  ...
-         [V_x_n, V_y_n, V_z_n]] - speeds of the n-th particle projected on x, y, z axes
+        Creating random speeds which are placed in as:
+        vx = [V_x_1, V_x_2, ..., V_x_n] - speeds of the particles projected on x axis
+        vy = [V_y_1, V_y_2, ..., V_y_n] - speeds of the particles projected on y axis
+        vz = [V_z_1, V_z_2, ..., V_z_n] - speeds of the particles projected on z axis
+        In Maxwell-Boltzmann distribution every projection is normally distributed with zero mean and standard
+        deviation of (kT/m) ** (1/2), so the gas starts in equilibrium instead of converging to it from uniform speeds.
         """
-        self.vel = random.uniform(-1, 1, (self.partCount, 3)) * self.velNormalized
+        sigma = (1.87e-23 * self.temp / self.mass) ** (1 / 2)
+        self.vx, self.vy, self.vz = random.normal(0.0, sigma, (3, self.partCount))
 
     def SetGraphs(self):
         """
@@ -112,95 +143,472 @@ class GasSimulation3d:
         self.distributionGraph.set_xlabel('Speed')
         self.distributionGraph.set_ylabel('Frequency')
 
-        # setting up initial histogram state
-        self.vel_hist_data = np.zeros(self.partCount)
-        for i in range(self.partCount):
-            self.vel_hist_data[i] = (self.vel[i, 0] ** 2 + self.vel[i, 1] ** 2 + self.vel[i, 2] ** 2) ** (1 / 2)
-
-    def Step(self, dt):
-        """
-        This module computes changes in system which happens after set period of time dt (aka steps).
-
-        Collisions between particles are only calculated for particles inside cells, which where defined in previous
-        module.
-
-        To do that, each step we first check to which cell does each particle belong. To do that we simply do 3*n
-        checks, where n - number of particles. After that we check collisions of particles inside of a cell.
-        This method improves our calculations time because in a straightforward approach we make n^2 calculations
-        (it is n*(n-1) to be exact but for big n in which we are interested we can say it is n^2) of
-        distances between particles, and after that we make (n^2)/2 checks of collisions. In this modified approach
-        we only make 3*n calculations of belongings, after that we make (n/m)^2 calculations of distances between
-        particles, where m - number of cells. And lastly we make m * ((n/m)^2)/2 checks of collisions. Therefore we only
-        do 3*n+(n/m)^2 calculations, which is less than n^2 by a lot in our situation. m * ((n/m)^2)/2 = (n^2)/2m, which
-        is less than (n^2)/2.
-        """
-
-        # updating positions of the particles after dt period of time
-        self.pos = self.pos + self.vel * dt
-
-
-        # calculating the positions of the particles inside of the cells
-        for i in range(self.partCount):
-            xCell = self.pos(i, 0) / self.cellLength
-            yCell = self.pos(i, 1) / self.cellLength
-            zCell = self.pos(i, 2) / self.cellLength
-            numCell = xCell + yCell * self.cubicParts1 + zCell * self.cubicParts2
-            self.cellBelonging[]
-
-
-        """
-        NEW VERSION:
-        We create a dictionary with number of keys equal to the number of cells, where each key corresponds to one
-        cell. Then each step we determine in which cell does each particle belong to. After that we are left with lists
-        of particles inside each cell.
-        """
-
-        # finding colliding particles, can be improved by creating a grid
-        distances = squareform(pdist(self.pos))
-        ind1, ind2 = np.where(distances < 2 * self.radius)
-        unique = (ind1 < ind2)
-        ind1 = ind1[unique]
-        ind2 = ind2[unique]
-
-        # calculating the result of the collision
-        for i1, i2 in zip(ind1, ind2):
-            vel_cm = (self.vel[i1] + self.vel[i2]) / 2
-            vec_normal = self.pos[i1] - self.pos[i2]
-            vel_normal = self.vel[i1] - self.vel[i2]
-            vel_change = 2 * np.dot(vec_normal, vel_normal) * vec_normal / np.dot(vec_normal, vec_normal) - vel_normal
-            self.vel[i1] = vel_cm - vel_change / 2
-            self.vel[i2] = vel_cm + vel_change / 2
-            self.pos[i1] += self.vel[i1] * dt
-            self.pos[i2] += self.vel[i2] * dt
-
-        # finding particles colliding with the wall and the change of momentum
-        for i in range(self.partCount):
-            if self.pos[i, [0]] - self.radius < 0:
-                self.vel[i, [0]] = -self.vel[i, [0]]
-                self.pos[i, [0]] = self.radius * 1.01
-                """
-                This is 
-                """
-                # # finding change of momentum
-                # self.dp += 2 * abs(self.vel[i, [0]]) * self.mass_non_normed
-                # self.counter += 1
-            if self.pos[i, [0]] + self.radius > self.sideLength:
-                self.vel[i, [0]] = -self.vel[i, [0]]
-                self.pos[i, [0]] = self.sideLength - (self.radius * 1.01)
-            if self.pos[i, [1]] - self.radius < 0:
-                self.vel[i, [1]] = -self.vel[i, [1]]
-                self.pos[i, [1]] = self.radius * 1.01
-            if self.pos[i, [1]] + self.radius > self.sideLength:
-                self.vel[i, [1]] = -self.vel[i, [1]]
-                self.pos[i, [1]] = self.sideLength - (self.radius * 1.01)
-            if self.pos[i, [2]] - self.radius < 0:
-                self.vel[i, [2]] = -self.vel[i, [2]]
-                self.pos[i, [2]] = self.radius * 1.01
-            if self.pos[i, [2]] + self.radius > self.sideLength:
-                self.vel[i, [2]] = -self.vel[i, [2]]
-                self.pos[i, [2]] = self.sideLength - (self.radius * 1.01)
+        # setting up initial histogram state, bars are created once and later only their heights are changed
+        edges = np.linspace(*self.histRange, self.histBins + 1)
+        self.histBars = self.distributionGraph.bar(edges[:-1], np.zeros(self.histBins), width=np.diff(edges),
+                                                   align='edge', lw=1, alpha=0.75)
+        self.UpdateHistogram()
+
+        # drawing the theoretical distribution once, it never changes
+        speeds = np.linspace(0, 5, 100)
+        self.theoryLine, = self.distributionGraph.plot(speeds, my_dist(speeds, self.mass, self.temp))
+
+    def SetDevice(self):
+        """
+        This module copies positions and velocities to the GPU and allocates the grid there. Instead of sorting the
+        particles, every cell gets cellCapacity slots, which are filled with atomic counters (see '_cuda_move').
+        """
+        self.devPos = [cuda.to_device(p) for p in (self.px, self.py, self.pz)]
+        self.devVel = [cuda.to_device(v) for v in (self.vx, self.vy, self.vz)]
+        self.devCellCounts = cuda.to_device(np.zeros(self.cellCount, dtype=np.int32))
+        self.devCellParticles = cuda.device_array((self.cellCount, self.cellCapacity), dtype=np.int32)
+        self.devOverflow = cuda.to_device(np.zeros(1, dtype=np.int32))
+
+    def Fetch(self):
+        """
+        This module copies positions and velocities from the GPU back to px, py, pz, vx, vy, vz, which is only needed
+        for drawing. Nothing is done for the 'cpu' backend.
+        """
+        if self.backend != 'cuda':
+            return
+        if self.devOverflow.copy_to_host()[0]:
+            raise RuntimeError('more than {} particles got into a single cell, increase cellCapacity'
+                               .format(self.cellCapacity))
+        for dev, host in zip(self.devPos + self.devVel, (self.px, self.py, self.pz, self.vx, self.vy, self.vz)):
+            dev.copy_to_host(host)
+
+    def UpdateHistogram(self):
+        """
+        This module sets heights of the bars of the histogram to the current speeds of the particles.
+        """
+        for bar, height in zip(self.histBars, self.HistogramHeights()):
+            bar.set_height(height)
+
+    def HistogramHeights(self):
+        """
+        This module recalculates speeds of the particles and returns heights of the bars of the speed histogram, which
+        are normalized in the same way as density=True of plt.hist, so that the histogram is comparable to the
+        Maxwell-Boltzmann distribution.
+        """
+        self.UpdateSpeeds()
+        counts, _ = np.histogram(self.vel_hist_data, bins=self.histBins, range=self.histRange)
+        return counts / (self.partCount * (self.histRange[1] - self.histRange[0]) / self.histBins)
+
+    def UpdateSpeeds(self):
+        """
+        This module writes absolute speeds of the particles into vel_hist_data. Squares of the components are summed
+        in place with the help of a single scratch buffer, so no temporary arrays are created.
+        """
+        speeds, scratch = self.vel_hist_data, self.vel_hist_scratch
+        np.multiply(self.vx, self.vx, out=speeds)
+        np.multiply(self.vy, self.vy, out=scratch)
+        np.add(speeds, scratch, out=speeds)
+        np.multiply(self.vz, self.vz, out=scratch)
+        np.add(speeds, scratch, out=speeds)
+        np.sqrt(speeds, out=speeds)
+
+    def Step(self, dt, subSteps=1):
+        """
+        This module computes changes in system which happens after set period of time dt (aka steps). The period can be
+        split into subSteps equal steps, which makes collisions more precise.
+
+        Collisions between particles are only checked for particles lying in the same or in the neighbouring cells of
+        the grid, which is explained in '_step_kernel'.
+
+        In a straightforward approach we make n^2 calculations (it is n*(n-1) to be exact but for big n in which we are
+        interested we can say it is n^2) of distances between particles, where n - number of particles. Since the side
+        of a cell is not less than the diameter of a molecule, colliding particles can only be found in the same cell
+        or in one of the 26 cells around it. Therefore we only make n calculations of belongings, after that we make
+        about 27 * n * (n/m) calculations of distances between particles, where m - number of cells, which is less
+        than n^2 by a lot in our situation.
+
+        If the cells are wider than the diameter by the skin, the grid does not have to be built every step. While no
+        particle went further than maxDrift = (cellLength - 2 * radius) / 2 from where it was sorted into its cell, two
+        colliding particles are still found in the same or in the neighbouring cells of the old grid.
+        """
 
+        dt /= subSteps
+        for _ in range(subSteps):
+            if self.backend == 'cuda':
+                self.StepCuda(dt)
+                continue
 
+            # updating positions of the particles, sorting them into the cells and calculating the results of collisions
+            self.gridBuilds += _step_kernel(self.px, self.py, self.pz, self.vx, self.vy, self.vz, *self.gridPos,
+                                            self.cellKeys, self.cellColours, self.sortedIdx, self.cellStart, self.cellFill,
+                                            self.colourCells, self.colourStart, self.radius, self.sideLength,
+                                            self.cellLength, self.cellsPerSide, self.maxDrift ** 2,
+                                            self.gridBuilds == 0, dt)
+
+
+    def StepCuda(self, dt):
+        """
+        This module computes the same step as 'Step' on the GPU. Collisions are calculated by one thread per cell. A cell
+        only touches particles of the cells around it, so cells {x, y, z} with the same x % 3, y % 3 and z % 3 never
+        touch the same particles and are processed at the same time, which takes 27 launches.
+        """
+        blocks = (self.partCount + THREADS_PER_BLOCK - 1) // THREADS_PER_BLOCK
+        n = self.cellsPerSide
+        _cuda_move[blocks, THREADS_PER_BLOCK](*self.devPos, *self.devVel, self.devCellCounts, self.devCellParticles,
+                                              self.devOverflow, self.cellLength, n, dt)
+        for colourZ in range(3):
+            for colourY in range(3):
+                for colourX in range(3):
+                    cells = ((n - colourX + 2) // 3) * ((n - colourY + 2) // 3) * ((n - colourZ + 2) // 3)
+                    if cells == 0:
+                        continue
+                    _cuda_collide_cells[(cells + THREADS_PER_BLOCK - 1) // THREADS_PER_BLOCK, THREADS_PER_BLOCK](
+                        *self.devPos, *self.devVel, self.devCellCounts, self.devCellParticles, colourX, colourY,
+                        colourZ, n, (2 * self.radius) ** 2)
+        _cuda_bounce[blocks, THREADS_PER_BLOCK](*self.devPos, *self.devVel, self.radius, self.sideLength)
+        _cuda_clear[(self.cellCount + THREADS_PER_BLOCK - 1) // THREADS_PER_BLOCK, THREADS_PER_BLOCK](
+            self.devCellCounts)
+
+
+@njit(cache=True, fastmath=True)
+def _collide(px, py, pz, vx, vy, vz, a, b, diameterSq):
+    """
+    Computing the result of the collision of particles a and b if they are closer to each other than 2 radii. Vectors
+    are processed component by component, so that the whole function is compiled into plain scalar code.
+
+    Positions were already updated by the step, so particles are not moved by their new velocities. Each of them is
+    only pushed away from the other by a half of the overlap, so that they touch and don't collide again.
+    """
+    vecNormalX = px[a] - px[b]
+    vecNormalY = py[a] - py[b]
+    vecNormalZ = pz[a] - pz[b]
+    distSq = vecNormalX * vecNormalX + vecNormalY * vecNormalY + vecNormalZ * vecNormalZ
+    if distSq >= diameterSq:
+        return
+
+    velNormalX = vx[a] - vx[b]
+    velNormalY = vy[a] - vy[b]
+    velNormalZ = vz[a] - vz[b]
+    velCmX = (vx[a] + vx[b]) / 2
+    velCmY = (vy[a] + vy[b]) / 2
+    velCmZ = (vz[a] + vz[b]) / 2
+
+    factor = 2 * (vecNormalX * velNormalX + vecNormalY * velNormalY + vecNormalZ * velNormalZ) / distSq
+    velChangeX = factor * vecNormalX - velNormalX
+    velChangeY = factor * vecNormalY - velNormalY
+    velChangeZ = factor * vecNormalZ - velNormalZ
+
+    vx[a] = velCmX - velChangeX / 2
+    vy[a] = velCmY - velChangeY / 2
+    vz[a] = velCmZ - velChangeZ / 2
+    vx[b] = velCmX + velChangeX / 2
+    vy[b] = velCmY + velChangeY / 2
+    vz[b] = velCmZ + velChangeZ / 2
+
+    # moving particles apart along the line between them
+    dist = distSq ** (1 / 2)
+    push = (diameterSq ** (1 / 2) - dist) / (2 * dist)
+    px[a] += vecNormalX * push
+    py[a] += vecNormalY * push
+    pz[a] += vecNormalZ * push
+    px[b] -= vecNormalX * push
+    py[b] -= vecNormalY * push
+    pz[b] -= vecNormalZ * push
+
+
+@njit(cache=True, fastmath=True)
+def _cell(p, cellLength, cellsPerSide):
+    """
+    Finding the cell of a particle along one axis, particles outside of the chamber go to the edge cells.
+    """
+    return min(max(int(p / cellLength), 0), cellsPerSide - 1)
+
+
+@njit(cache=True, fastmath=True)
+def _bounce(p, v, i, radius, side):
+    """
+    Reflecting particle i from the walls perpendicular to one axis and placing it back inside of the chamber.
+    """
+    if p[i] < radius:
+        v[i] = -v[i]
+        p[i] = radius * 1.01
+    elif p[i] > side - radius:
+        v[i] = -v[i]
+        p[i] = side - (radius * 1.01)
+
+
+@njit(cache=True, fastmath=True, inline='always')
+def _sort_cells(keys, sortedIdx, cellStart, fill):
+    """
+    Sorting particles by the numbers of their cells, see '_step_kernel'. Particles are counted in every cell first and
+    then placed after the particles of all previous cells.
+    """
+    cellStart[:] = 0
+    for i in range(keys.shape[0]):
+        cellStart[keys[i] + 1] += 1
+    for cell in range(cellStart.shape[0] - 1):
+        cellStart[cell + 1] += cellStart[cell]
+    fill[:] = cellStart[:-1]
+    for i in range(keys.shape[0]):
+        sortedIdx[fill[keys[i]]] = i
+        fill[keys[i]] += 1
+
+
+@njit(cache=True, fastmath=True, inline='always')
+def _sort_colours(keys, colours, sortedIdx, cellStart, colourCells, colourStart):
+    """
+    Sorting cells which have particles by their colours in the same way as '_sort_cells' sorts particles, colours[i] is
+    the colour of the cell of the particle i. Occupied cells of the colour k are
+    colourCells[colourStart[k]:colourStart[k + 1]].
+    """
+    colourStart[:] = 0
+    for slot in range(sortedIdx.shape[0]):
+        if cellStart[keys[sortedIdx[slot]]] == slot:
+            colourStart[colours[sortedIdx[slot]] + 1] += 1
+    for colour in range(27):
+        colourStart[colour + 1] += colourStart[colour]
+    fill = colourStart[:-1].copy()
+    for slot in range(sortedIdx.shape[0]):
+        if cellStart[keys[sortedIdx[slot]]] == slot:
+            colourCells[fill[colours[sortedIdx[slot]]]] = keys[sortedIdx[slot]]
+            fill[colours[sortedIdx[slot]]] += 1
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _step_kernel(px, py, pz, vx, vy, vz, gridX, gridY, gridZ, keys, colours, sortedIdx, cellStart, fill, colourCells,
+                 colourStart, radius, side, cellLength, cellsPerSide, maxDriftSq, forceRebuild, dt):
+    """
+    Computing one step of the simulation in a single call of compiled code, so that positions and velocities are
+    streamed through the cache as few times as possible.
+
+    The chamber is split into a grid of cellsPerSide ** 3 cubic cells. Cells are numbered from x to y to z axes in the
+    same way as described in 'SetParticles', so a cell {x, y, z} has a number x + y * cellsPerSide + z * cellsPerSide ** 2.
+    The grid is stored in a compressed form: sortedIdx contains numbers of the particles sorted by the number of their
+    cell, while particles of the cell k are sortedIdx[cellStart[k]:cellStart[k + 1]]. Each particle is then compared
+    with the particles of its own cell and of 13 out of 26 neighbouring cells, the other 13 are covered by the
+    neighbours themselves (pair {a, b} is the same as pair {b, a}).
+
+    Edges of the cell {x, y, z} along x axis are x * cellLength and (x + 1) * cellLength, the same for other axes, so
+    they are never stored.
+
+    The grid is only built again if forceRebuild is set or some particle went further than maxDriftSq ** (1/2) from
+    the position at which it was sorted into its cell, these positions are kept in gridX, gridY, gridZ. Returns
+    whether the grid was built.
+
+    A cell only touches particles of the cells around it, so cells {x, y, z} with the same x % 3, y % 3 and z % 3 (of
+    the same colour x % 3 + y % 3 * 3 + z % 3 * 9) never touch the same particles and their collisions are calculated
+    in parallel, one colour after another. Only cells which have particles are visited, they are kept in colourCells
+    and colourStart (see '_sort_colours').
+
+    All the arrays after the velocities are overwritten: sortedIdx, cellStart, colourCells and colourStart keep the
+    grid, keys and colours hold the number and the colour of the cell of each particle and fill is used while sorting
+    the particles.
+    """
+    n = px.shape[0]
+
+    # updating positions of the particles and finding how far they went from their positions in the grid
+    driftSq = 0.0
+    for i in prange(n):
+        px[i] += vx[i] * dt
+        py[i] += vy[i] * dt
+        pz[i] += vz[i] * dt
+        driftSq = max(driftSq, (px[i] - gridX[i]) ** 2 + (py[i] - gridY[i]) ** 2 + (pz[i] - gridZ[i]) ** 2)
+    rebuild = forceRebuild or driftSq >= maxDriftSq
+
+    if rebuild:
+        # finding cells of the particles and their colours, particles outside of the chamber go to the edge cells
+        for i in prange(n):
+            gridX[i] = px[i]
+            gridY[i] = py[i]
+            gridZ[i] = pz[i]
+            cellX = _cell(px[i], cellLength, cellsPerSide)
+            cellY = _cell(py[i], cellLength, cellsPerSide)
+            cellZ = _cell(pz[i], cellLength, cellsPerSide)
+            keys[i] = cellX + (cellY + cellZ * cellsPerSide) * cellsPerSide
+            colours[i] = cellX % 3 + (cellY % 3) * 3 + (cellZ % 3) * 9
+
+        # sorting particles by their cells and occupied cells by their colours
+        _sort_cells(keys, sortedIdx, cellStart, fill)
+        _sort_colours(keys, colours, sortedIdx, cellStart, colourCells, colourStart)
+
+    # calculating the results of the collisions between particles, cells of one colour at a time
+    diameterSq = (2 * radius) ** 2
+    for colour in range(27):
+        for c in prange(colourStart[colour], colourStart[colour + 1]):
+            cell = colourCells[c]
+            cellX = cell % cellsPerSide
+            cellY = (cell // cellsPerSide) % cellsPerSide
+            cellZ = cell // (cellsPerSide * cellsPerSide)
+            for slot in range(cellStart[cell], cellStart[cell + 1]):
+                a = sortedIdx[slot]
+                for o in range(NEIGHBOUR_OFFSETS.shape[0]):
+                    neighbourX = cellX + NEIGHBOUR_OFFSETS[o, 0]
+                    neighbourY = cellY + NEIGHBOUR_OFFSETS[o, 1]
+                    neighbourZ = cellZ + NEIGHBOUR_OFFSETS[o, 2]
+                    if not (0 <= neighbourX < cellsPerSide and 0 <= neighbourY < cellsPerSide and
+                            0 <= neighbourZ < cellsPerSide):
+                        continue
+                    neighbour = neighbourX + (neighbourY + neighbourZ * cellsPerSide) * cellsPerSide
+                    first = slot + 1 if neighbour == cell else cellStart[neighbour]
+                    for other in range(first, cellStart[neighbour + 1]):
+                        _collide(px, py, pz, vx, vy, vz, a, sortedIdx[other], diameterSq)
+
+    # finding particles colliding with the wall
+    for i in prange(n):
+        _bounce(px, vx, i, radius, side)
+        _bounce(py, vy, i, radius, side)
+        _bounce(pz, vz, i, radius, side)
+    return rebuild
+
+
+# the same functions compiled for the GPU
+_cuda_collide_device = cuda.jit(device=True)(_collide.py_func)
+_cuda_cell_device = cuda.jit(device=True)(_cell.py_func)
+_cuda_bounce_device = cuda.jit(device=True)(_bounce.py_func)
+
+
+@cuda.jit
+def _cuda_move(px, py, pz, vx, vy, vz, cellCounts, cellParticles, overflow, cellLength, cellsPerSide, dt):
+    """
+    Updating the position of one particle per thread and putting it into a free slot of its cell.
+    """
+    i = cuda.grid(1)
+    if i >= px.shape[0]:
+        return
+    px[i] += vx[i] * dt
+    py[i] += vy[i] * dt
+    pz[i] += vz[i] * dt
+    key = _cuda_cell_device(px[i], cellLength, cellsPerSide) + (_cuda_cell_device(py[i], cellLength, cellsPerSide) +
+          _cuda_cell_device(pz[i], cellLength, cellsPerSide) * cellsPerSide) * cellsPerSide
+    slot = cuda.atomic.add(cellCounts, key, 1)
+    if slot < cellParticles.shape[1]:
+        cellParticles[key, slot] = i
+    else:
+        overflow[0] = 1
+
+
+@cuda.jit
+def _cuda_collide_cells(px, py, pz, vx, vy, vz, cellCounts, cellParticles, colourX, colourY, colourZ, cellsPerSide,
+                        diameterSq):
+    """
+    Calculating collisions of the particles of one cell per thread with the particles of its own cell and of 13
+    neighbouring cells, only cells of one colour (see 'StepCuda') are processed by a single launch.
+    """
+    t = cuda.grid(1)
+    cellsX = (cellsPerSide - colourX + 2) // 3
+    cellsY = (cellsPerSide - colourY + 2) // 3
+    cellsZ = (cellsPerSide - colourZ + 2) // 3
+    if t >= cellsX * cellsY * cellsZ:
+        return
+    cellX = colourX + 3 * (t % cellsX)
+    cellY = colourY + 3 * ((t // cellsX) % cellsY)
+    cellZ = colourZ + 3 * (t // (cellsX * cellsY))
+    cell = cellX + (cellY + cellZ * cellsPerSide) * cellsPerSide
+    capacity = cellParticles.shape[1]
+    for slot in range(min(cellCounts[cell], capacity)):
+        a = cellParticles[cell, slot]
+        for o in range(NEIGHBOUR_OFFSETS.shape[0]):
+            neighbourX = cellX + NEIGHBOUR_OFFSETS[o, 0]
+            neighbourY = cellY + NEIGHBOUR_OFFSETS[o, 1]
+            neighbourZ = cellZ + NEIGHBOUR_OFFSETS[o, 2]
+            if not (0 <= neighbourX < cellsPerSide and 0 <= neighbourY < cellsPerSide and
+                    0 <= neighbourZ < cellsPerSide):
+                continue
+            neighbour = neighbourX + (neighbourY + neighbourZ * cellsPerSide) * cellsPerSide
+            first = slot + 1 if neighbour == cell else 0
+            for other in range(first, min(cellCounts[neighbour], capacity)):
+                _cuda_collide_device(px, py, pz, vx, vy, vz, a, cellParticles[neighbour, other], diameterSq)
+
+
+@cuda.jit
+def _cuda_bounce(px, py, pz, vx, vy, vz, radius, side):
+    """
+    Reflecting one particle per thread from the walls.
+    """
+    i = cuda.grid(1)
+    if i < px.shape[0]:
+        _cuda_bounce_device(px, vx, i, radius, side)
+        _cuda_bounce_device(py, vy, i, radius, side)
+        _cuda_bounce_device(pz, vz, i, radius, side)
+
+
+@cuda.jit
+def _cuda_clear(cellCounts):
+    """
+    Emptying the cells before the next step.
+    """
+    c = cuda.grid(1)
+    if c < cellCounts.shape[0]:
+        cellCounts[c] = 0
+
+
+class QtView:
+
+    def __init__(self, simulation, dt, subSteps=1, interval=20):
+        """
+        Drawing the simulation with vispy (OpenGL) and pyqtgraph instead of matplotlib. Particles are uploaded to the
+        GPU as a single vertex buffer and bars of the histogram only change their heights, so drawing a frame takes
+        only a small part of its time. The simulation is stepped by a QTimer every interval milliseconds while Qt
+        repaints the window on its own, dt is split into subSteps steps in the same way as in 'GasSimulation3d.Step'.
+        """
+        import pyqtgraph as pg
+        from pyqtgraph.Qt import QtCore, QtWidgets
+        from vispy import scene
+
+        self.simulation = simulation
+        self.dt = dt
+        self.subSteps = subSteps
+        self.app = pg.mkQApp()
+
+        # particles graph, coordinates are scaled so that the chamber is a unit cube
+        self.canvas = scene.SceneCanvas(keys='interactive', bgcolor='white')
+        view = self.canvas.central_widget.add_view()
+        view.camera = scene.TurntableCamera(fov=45, distance=2.5, center=(0.5, 0.5, 0.5))
+        scene.visuals.Box(width=1, height=1, depth=1, color=None, edge_color='black', parent=view.scene).transform = \
+            scene.transforms.STTransform(translate=(0.5, 0.5, 0.5))
+        self.molecules = scene.visuals.Markers(parent=view.scene)
+        self.positions = np.empty((simulation.partCount, 3), dtype=np.float32)
+
+        # distribution graph with theoretical Maxwell-Boltzmann distribution
+        self.distributionGraph = pg.PlotWidget(labels={'bottom': 'Speed', 'left': 'Frequency'}, background='w')
+        self.distributionGraph.setXRange(*simulation.histRange)
+        self.distributionGraph.setYRange(0, 2)
+        edges = np.linspace(*simulation.histRange, simulation.histBins + 1)
+        self.histBars = pg.BarGraphItem(x0=edges[:-1], width=np.diff(edges), height=np.zeros(simulation.histBins))
+        self.distributionGraph.addItem(self.histBars)
+        speeds = np.linspace(0, 5, 100)
+        self.distributionGraph.plot(speeds, my_dist(speeds, simulation.mass, simulation.temp), pen='b')
+
+        self.window = QtWidgets.QWidget()
+        layout = QtWidgets.QHBoxLayout(self.window)
+        layout.addWidget(self.canvas.native, stretch=2)
+        layout.addWidget(self.distributionGraph, stretch=1)
+        self.window.resize(1040, 585)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.Update)
+        self.timer.start(interval)
+        self.Draw()
+
+    def Update(self):
+        """
+        This module computes one frame of the simulation and redraws it.
+        """
+        self.simulation.Step(self.dt, self.subSteps)
+        self.simulation.Fetch()
+        self.Draw()
+
+    def Draw(self):
+        """
+        This module uploads positions of the particles and heights of the histogram bars.
+        """
+        simulation = self.simulation
+        for ax, p in enumerate((simulation.px, simulation.py, simulation.pz)):
+            np.divide(p, simulation.sideLength, out=self.positions[:, ax], casting='unsafe')
+        self.molecules.set_data(self.positions, face_color='blue', edge_width=0, size=3)
+        self.histBars.setOpts(height=simulation.HistogramHeights())
+
+    def Run(self):
+        """
+        This module shows the window and runs Qt event loop.
+        """
+        self.window.show()
+        self.app.exec_()
 
 
 def init():
@@ -208,48 +616,35 @@ def init():
     molecules.set_data_3d([], [], [])
     ax2.set_xlim(0, 1.5)
     ax2.set_ylim(0, 2)
-    return molecules,
+    return list(abobus_3d.histBars) + [molecules]
 
 def animate(a):
-    global abobus_3d, dt, bars, data
-    ax2.clear()
-    ax2.set_xlim(0, 1.5)
-    ax2.set_ylim(0, 2)
-    abobus_3d.Step(dt)
-    molecules.set_data_3d(abobus_3d.pos[:, 0], abobus_3d.pos[:, 1], abobus_3d.pos[:, 2])
+    global abobus_3d, dt, subSteps
+    abobus_3d.Step(dt, subSteps)
+    abobus_3d.Fetch()
+    molecules.set_data_3d(abobus_3d.px, abobus_3d.py, abobus_3d.pz)
     molecules.set_markersize(1)
-    for i in range(abobus_3d.partCount):
-        data[i] = (abobus_3d.vel[i, 0] ** 2 + abobus_3d.vel[i, 1] ** 2 + abobus_3d.vel[i, 2] ** 2) ** (1 / 2)
-    _, _, bars = ax2.hist(data, bins = 100, lw=1, density=True, alpha=0.75)
-    ax2.plot(x, p)
+    abobus_3d.UpdateHistogram()
     # plt.savefig(str(a) + ".png")
-    return bars.patches + [molecules]
+    return list(abobus_3d.histBars) + [molecules]
 
 def my_dist(v, mass, temp):
     return ((2 / np.pi) ** (1/2)) * ((mass / (1.87e-23 * temp)) ** (3/2)) * \
            (v ** 2) * np.exp(-mass * (v ** 2) / (2 * 1.87e-23 * temp))
 
 
-abobus_3d = GasSimulation3d()
-x = np.linspace(0, 5, 100)
-p = my_dist(x, abobus_3d.mass, 300)
+renderer = 'matplotlib'  # 'matplotlib' or 'qt', the latter needs vispy, pyqtgraph and a Qt binding e.g. PyQt5
 dt = 1. / 800000000
-fig = abobus_3d.figure
-ax1 = abobus_3d.particleGraph
-ax2 = abobus_3d.distributionGraph
-ax2.plot(x, p)
-data = abobus_3d.vel_hist_data
-_, _, bars = ax2.hist([], bins = 100, lw=1, density=True, alpha=0.75)
-molecules, = ax1.plot([], [], [], 'p')
-ani = animation.FuncAnimation(fig, animate, frames=300, interval=20, blit=True, init_func=init)
-#ani.save('particle_box_3d_test.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
-print(abobus_3d.cellBelonging)
-plt.show()
-
-
-
-"""
-We have to determine how do we number the cells. Suppose we have m cells. Then the cells are numbered from x to y to z
-axes. Then the first cell would be the top-most left-most closest cell. The second cell would be to the right to the
-first etc. In short we number them as described in SetParticles function.
-"""
\ No newline at end of file
+subSteps = 1  # steps of the simulation per frame, dt is split between them
+if renderer == 'qt':
+    abobus_3d = GasSimulation3d(graphs=False)
+    QtView(abobus_3d, dt, subSteps).Run()
+else:
+    abobus_3d = GasSimulation3d()
+    fig = abobus_3d.figure
+    ax1 = abobus_3d.particleGraph
+    ax2 = abobus_3d.distributionGraph
+    molecules, = ax1.plot([], [], [], 'p')
+    ani = animation.FuncAnimation(fig, animate, frames=300, interval=20, blit=True, init_func=init)
+    #ani.save('particle_box_3d_test.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
+    plt.show()